@@ -24,30 +24,58 @@ RULINGS
 Reference https://scryfall.com/docs/api/bulk-data
 """
 
+from __future__ import annotations
+
+import argparse
 import configparser
 import datetime
+import functools
+import itertools
 import logging
 import logging.config
+import os
+import queue
+import threading
+from collections import defaultdict
 from enum import Enum
 from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Iterator
 
-import pandas as pd
+import ijson
+import orjson
 import requests
-import sqlalchemy
-from sqlalchemy.exc import IntegrityError
+import zstandard
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logging.config.fileConfig("logger.conf")
 
 # create logger
 logger = logging.getLogger("simpleExample")
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-
-MYSQL_USER = config["mysql"]["user"]
-MYSQL_PASSWORD = config["mysql"]["password"]
-MYSQL_HOST = config["mysql"]["host"]
-MYSQL_DB = config["mysql"]["database"]
+KEEP_COLS = ["name", "set_name", "rarity", "colors", "cmc", "type_line"]
+BATCH_SIZE = 1000  # rows sent to the database per statement
+CACHE_FILE = "bulk_cache.ini"  # validators for the last downloaded bulk files
+CHUNK_SIZE = 1024 * 1024  # bytes per chunk when streaming the bulk file
+ZSTD_LEVEL = 3  # compression level for the saved bulk file
+QUEUE_SIZE = 16  # downloaded chunks allowed to wait on the parser
+
+# Shared session so back to back requests reuse the pooled connection
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_maxsize=4,
+        # hand the final response back once retries run out
+        # so get_data's own status checks still raise BulkDataErrors
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        ),
+    ),
+)
 
 
 class BulkDataError(Exception):
@@ -78,6 +106,26 @@ class DataTypeNotFoundError(BulkDataError):
         super().__init__(f"Data type '{data_type}' not found in bulk data.")
 
 
+@functools.lru_cache
+def db_config() -> configparser.SectionProxy:
+    """Read the database credentials from config.ini"""
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    return config["mysql"]
+
+
+def get_session() -> requests.Session:
+    """Return the session used for all requests to Scryfall"""
+    return _SESSION
+
+
+class DownloadCancelledError(BulkDataError):
+    """Raised when a download is stopped before it finished."""
+
+    def __init__(self):
+        super().__init__("Download cancelled before it finished.")
+
+
 class BulkDataType(Enum):
     """
     Restrict the types of files that can be requested
@@ -90,95 +138,313 @@ class BulkDataType(Enum):
     RULINGS = "rulings"
 
 
-def get_data(data_type: BulkDataType) -> str:
-    """Pull the bulk data json file from Scryfall"""
+# The file types that hold card objects and so can be loaded into the table
+CARD_DATA_TYPES = [
+    BulkDataType.ORACLE,
+    BulkDataType.UNIQUE,
+    BulkDataType.DEFAULT,
+    BulkDataType.ALL,
+]
+
+
+def read_cache(data_type: BulkDataType) -> dict[str, str]:
+    """Read what is known about the last file downloaded for this data type"""
+    cache = configparser.ConfigParser(interpolation=None)
+    cache.read(CACHE_FILE)
+    if not cache.has_section(data_type.value):
+        return {}
+    return dict(cache[data_type.value])
+
+
+def write_cache(data_type: BulkDataType, entry: dict[str, str]) -> None:
+    """Record the file downloaded for this data type and its validators"""
+    cache = configparser.ConfigParser(interpolation=None)
+    cache.read(CACHE_FILE)
+    cache[data_type.value] = entry
+    with open(CACHE_FILE, "w", encoding="utf-8") as file:
+        cache.write(file)
+
+
+def get_data(
+    data_type: BulkDataType,
+    dest_dir: Path = Path("."),
+    session: requests.Session = None,
+    on_chunk: Callable[[bytes], None] = None,
+) -> str:
+    """
+    Pull the bulk data json file from Scryfall into dest_dir
+
+    If given, on_chunk is called with each piece of the json as it is
+    downloaded; it is not called when the local file is already current
+    """
     logger.info("Pulling data from Scryfall")
+    session = session or get_session()
     url = "https://api.scryfall.com/bulk-data"
 
     # Fetch bulk data info
-    response = requests.get(url, timeout=60 * 5)
+    response = session.get(url, timeout=60 * 5)
     if response.status_code != 200:
         raise FetchDataError(response.status_code)
 
     # Find the correct file type based on the param passed in
-    data = response.json()
-    file_url = None
-    for bulk_data in data.get("data", []):
-        if bulk_data["type"] == data_type.value:
-            file_url = bulk_data["download_uri"]
-            break
-    if not file_url:
-        raise DataTypeNotFoundError(data_type.value)
-
-    # Pull the file itself
-    file_response = requests.get(file_url, timeout=60 * 5)
-    if file_response.status_code != 200:
-        raise DownloadError(response.status_code)
-    file_name = f"{datetime.date.today():%Y%m%d}_{data_type.value}_scryfall.json"
-    with open(file_name, "wb") as file:
-        file.write(file_response.content)
+    data = orjson.loads(response.content)
+    type_name = data_type.value
+    bulk_data_by_type = {
+        bulk_data["type"]: bulk_data for bulk_data in data.get("data", [])
+    }
+    try:
+        bulk_data = bulk_data_by_type[type_name]
+    except KeyError:
+        raise DataTypeNotFoundError(type_name) from None
+    file_url = bulk_data["download_uri"]
+    updated_at = bulk_data.get("updated_at", "")
+
+    # Skip the download entirely if the last file pulled is still current
+    cache = read_cache(data_type)
+    cached_file = cache.get("file")
+    headers = {}
+    if cached_file and Path(cached_file).exists():
+        if updated_at and cache.get("updated_at") == updated_at:
+            logger.info(f"'{cached_file}' is already up to date")
+            return cached_file
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+    # Stream the file itself to disk rather than holding it all in memory,
+    # recompressing it as it goes since the json is mostly repeated strings
+    file_name = str(
+        dest_dir.joinpath(
+            f"{datetime.date.today():%Y%m%d}_{type_name}_scryfall.json.zst"
+        )
+    )
+    with session.get(
+        file_url, headers=headers, timeout=60 * 5, stream=True
+    ) as file_response:
+        if file_response.status_code == 304:
+            logger.info(f"'{cached_file}' has not been modified")
+            return cached_file
+        if file_response.status_code != 200:
+            raise DownloadError(file_response.status_code)
+        # Write to a temporary file so a failed download never leaves
+        # a truncated file behind under the real name
+        part_name = f"{file_name}.part"
+        try:
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            with open(part_name, "wb") as raw, compressor.stream_writer(raw) as file:
+                for chunk in file_response.iter_content(chunk_size=CHUNK_SIZE):
+                    file.write(chunk)
+                    if on_chunk:
+                        on_chunk(chunk)
+            os.replace(part_name, file_name)
+        except BaseException:
+            Path(part_name).unlink(missing_ok=True)
+            raise
+        write_cache(
+            data_type,
+            {
+                "file": file_name,
+                "etag": file_response.headers.get("ETag", ""),
+                "last_modified": file_response.headers.get("Last-Modified", ""),
+                "updated_at": updated_at,
+            },
+        )
     logger.info(f"File downloaded successfully as '{file_name}'")
 
     return file_name
 
 
-def flatten_list(color_list: list) -> str:
+def open_bulk_file(path: str) -> BinaryIO:
+    """Open a downloaded bulk file, decompressing it if it was saved as zstd"""
+    if str(path).endswith(".zst"):
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def cache_path(json: str) -> Path:
+    """Where the cleaned rows for a bulk file are cached"""
+    return Path(str(json).removesuffix(".zst")).with_suffix(".rows.json.zst")
+
+
+def write_rows(json: str, rows: list[tuple[str, ...]]) -> None:
+    """Cache the cleaned rows for a bulk file next to it"""
+    rows_path = cache_path(json)
+    part_path = rows_path.with_name(f"{rows_path.name}.part")
+    try:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        with open(part_path, "wb") as raw, compressor.stream_writer(raw) as file:
+            file.write(orjson.dumps(rows))
+        os.replace(part_path, rows_path)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+
+
+def empty_row() -> dict[str, set]:
+    """The sets a card's printings are aggregated into"""
+    return {col: set() for col in KEEP_COLS[1:]}
+
+
+def add_card(cards: dict[str, dict[str, set]], card: dict) -> None:
+    """Fold one printing into the sets for its card name"""
+    name = card.get("name")
+    if name is None:
+        return
+    row = cards[name]
+    row["set_name"].add(card.get("set_name") or "")
+    row["rarity"].add(card.get("rarity") or "")
+    row["type_line"].add(card.get("type_line") or "")
+    row["colors"].update(card.get("colors") or ())
+    cmc = card.get("cmc")
+    if cmc is not None:
+        row["cmc"].add(cmc)
+
+
+@functools.lru_cache(maxsize=None)
+def join_colors(colors: frozenset[str]) -> str:
     """
-    The 'color' row comes in as lists of lists
-    In order to aggregate the df by name, flatten the 2d list
-    and move the data to a string
+    Cards only have a handful of color combinations between them,
+    so each joined string is built once and reused
 
-    [['R', 'G', 'B'], ['R', 'G', 'B'], ['R', 'G', 'B']] -> "R, G, B"
+    {'R', 'G', 'B'} -> "B, G, R"
     """
-    if (isinstance(color_list, list) and not color_list) or (
-        not isinstance(color_list, list) and pd.isna(color_list)
-    ):  # empty list or pandas null
-        return ""
+    return ", ".join(sorted(colors))
+
 
-    color_list: list[str] = [
-        str(element)
-        for innerList in color_list
-        for element in innerList
-        if pd.notna(element)
-    ]
-    color_list = set(color_list)  # remove duplicates
-    color_list = ", ".join(color_list)
+def to_rows(cards: dict[str, dict[str, set]]) -> Iterator[tuple[str, ...]]:
+    """
+    Turn the aggregated sets into strings for SQL, one tuple per card name
+
+    Cards are removed from the dict as they are emitted
+    """
+    while cards:
+        name, row = cards.popitem()
+        # cmc is cast float -> int once per name rather than once per printing
+        cmc = sorted({int(value) for value in row["cmc"]})
+        yield (
+            name,
+            ", ".join(sorted(element for element in row["set_name"] if element)),
+            ", ".join(sorted(element for element in row["rarity"] if element)),
+            join_colors(frozenset(row["colors"])),
+            ", ".join(str(value) for value in cmc),
+            ", ".join(sorted(element for element in row["type_line"] if element)),
+        )
 
-    return color_list
 
+def read_cards(json: str) -> dict[str, dict[str, set]]:
+    """
+    Stream the json and aggregate every printing of a card by name
 
-def read_data(json: str) -> pd.DataFrame:
-    """Read the json and then clean it up and make it usable"""
+    Only the columns we keep are pulled out of each card, so the full
+    file never has to be held in memory
+    """
     logger.info("Reading data")
-    df = pd.read_json(json)
-
-    # filter columns
-    keep_cols = ["name", "set_name", "rarity", "colors", "cmc", "type_line"]
-    df = df[keep_cols]
-
-    # clean a couple cols
-    df["colors"] = df["colors"].apply(flatten_list)
-    df["cmc"] = df["cmc"].apply(
-        lambda x: str(int(x)) if pd.notna(x) else pd.NA
-    )  # float -> int
-
-    # aggregate rows by name, turn sets into strings for SQL
-    df = df.fillna("")
-    df = df.groupby("name").agg(set).reset_index()
-    for col in keep_cols[1:]:
-        df[col] = df[col].apply(
-            lambda x: ", ".join([element for element in x if element != ""])
+    if ijson.backend != "yajl2_c":
+        logger.warning(
+            f"ijson is using its '{ijson.backend}' backend, parsing will be slow"
         )
 
-    return df
+    cards = defaultdict(empty_row)
+    with open_bulk_file(json) as file:
+        for card in ijson.items(file, "item", buf_size=CHUNK_SIZE, use_float=True):
+            add_card(cards, card)
+
+    return cards
+
+
+def read_rows(json: str) -> list[tuple[str, ...]]:
+    """Read the cleaned rows for a bulk file, reusing the cache if it is current"""
+    rows_path = cache_path(json)
+    if rows_path.exists() and rows_path.stat().st_mtime >= Path(json).stat().st_mtime:
+        logger.info(f"Reading cached rows from '{rows_path}'")
+        with open_bulk_file(rows_path) as file:
+            return [tuple(row) for row in orjson.loads(file.read())]
+
+    rows = list(to_rows(read_cards(json)))
+    write_rows(json, rows)
 
+    return rows
 
-def update_db(data: pd.DataFrame) -> None:
-    """Add the scryfall data into the database"""
-    logger.info(f"Reading {len(data)} records into database")
+
+def fetch_rows(
+    data_type: BulkDataType, dest_dir: Path = Path(".")
+) -> list[tuple[str, ...]]:
+    """
+    Download the bulk data json file and aggregate it at the same time
+
+    The download runs in a background thread that hands each chunk to
+    the parser as it arrives, so parsing overlaps the network transfer
+    instead of waiting for the whole file
+    """
+    chunks = queue.Queue(maxsize=QUEUE_SIZE)
+    cancel = threading.Event()
+    download = {"started": False}
+
+    def on_chunk(chunk: bytes) -> None:
+        if cancel.is_set():
+            raise DownloadCancelledError()
+        download["started"] = True
+        chunks.put(chunk)
+
+    def run_download():
+        try:
+            download["file"] = get_data(data_type, dest_dir, on_chunk=on_chunk)
+        except Exception as e:
+            download["error"] = e
+        finally:
+            chunks.put(None)
+
+    thread = threading.Thread(target=run_download, daemon=True)
+    thread.start()
+
+    cards = defaultdict(empty_row)
+    items = ijson.sendable_list()
+    parser = ijson.items_coro(items, "item", use_float=True)
+    try:
+        while (chunk := chunks.get()) is not None:
+            parser.send(chunk)
+            for card in items:
+                add_card(cards, card)
+            del items[:]
+    except BaseException:
+        # stop the download and drain the queue so the thread can finish
+        cancel.set()
+        while chunks.get() is not None:
+            pass
+        raise
+    finally:
+        thread.join()
+
+    if "error" in download:
+        raise download["error"]
+    if not download["started"]:
+        # nothing was downloaded, the local file is already current
+        return read_rows(download["file"])
+
+    parser.close()
+    for card in items:
+        add_card(cards, card)
+    rows = list(to_rows(cards))
+    write_rows(download["file"], rows)
+
+    return rows
+
+
+def update_db(rows: Iterable[tuple[str, ...]]) -> None:
+    """
+    Add the scryfall data into the database
+
+    rows are tuples in KEEP_COLS order, as returned by read_rows()
+    """
+    # slow to import, so only pulled in when the database is updated
+    import sqlalchemy
+
+    config = db_config()
     logger.info("Setting up database connection")
     engine = sqlalchemy.create_engine(
-        f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{MYSQL_DB}"
+        f"mysql+pymysql://{config['user']}:{config['password']}"
+        f"@{config['host']}/{config['database']}"
     )
 
     # Define metadata and table object
@@ -203,39 +469,64 @@ def update_db(data: pd.DataFrame) -> None:
         logger.info("Creating table")
         metadata.create_all(engine)
 
-    with engine.connect() as connection:
-        logger.info("Connected to database")
-        # Convert DataFrame to a list of dictionaries
-        rows = data.to_dict(orient="records")
-
-        for row in rows:
-            try:
-                # Attempt to insert; if it fails due to PK restriction, perform an update
-                connection.execute(scryfall_table.insert(), row)
-            except IntegrityError:
-                connection.execute(
-                    scryfall_table.update().where(scryfall_table.c.name == row["name"]),
-                    row,
-                )
-            except Exception as e:
-                logger.error(f"Error processing row {row}: {e}")
-                raise e
+    # Insert new cards and update existing ones, handing the driver plain
+    # tuples so it can batch them into multi-row inserts;
+    # deck is not part of the data so it is left alone on existing rows
+    sql = (
+        f"INSERT INTO scryfall ({', '.join(KEEP_COLS)}) "
+        f"VALUES ({', '.join(['%s'] * len(KEEP_COLS))}) "
+        "ON DUPLICATE KEY UPDATE "
+        + ", ".join(f"{col} = VALUES({col})" for col in KEEP_COLS[1:])
+    )
+    rows = iter(rows)
+    count = 0
+
+    connection = engine.raw_connection()
+    logger.info("Connected to database")
+    try:
+        with connection.cursor() as cursor:
+            while batch := list(itertools.islice(rows, BATCH_SIZE)):
+                cursor.executemany(sql, batch)
+                count += len(batch)
         connection.commit()
+        logger.info(f"Read {count} records into database")
+    except Exception as e:
+        connection.rollback()
+        logger.error(f"Error loading records into database: {e}")
+        raise e
+    finally:
+        connection.close()
 
 
-def main(file: Path = None):
+def main(file: Path = None, data_type: BulkDataType = BulkDataType.DEFAULT):
     """Driver function"""
     logger.info("Starting script")
     if not file or not file.exists():
-        file = get_data(BulkDataType.DEFAULT)
-    df = read_data(file)
-    update_db(df)
+        rows = fetch_rows(data_type, file.parent if file else Path("."))
+    else:
+        rows = read_rows(file)
+    update_db(rows)
     logger.info("Script complete!")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load Scryfall bulk data into the scryfall table"
+    )
+    parser.add_argument(
+        "--data-type",
+        choices=[data_type.name.lower() for data_type in CARD_DATA_TYPES],
+        default=BulkDataType.DEFAULT.name.lower(),
+        help=(
+            "bulk file to load; 'oracle' already has one card per name, "
+            "so it is far smaller to download and aggregate than 'default' or 'all'"
+        ),
+    )
+    args = parser.parse_args()
+    data_type = BulkDataType[args.data_type.upper()]
     main(
         Path(__file__).parent.joinpath(
-            f"{datetime.date.today():%Y%m%d}_default_cards_scryfall.json"
-        )
+            f"{datetime.date.today():%Y%m%d}_{data_type.value}_scryfall.json.zst"
+        ),
+        data_type,
     )